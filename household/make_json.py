@@ -6,128 +6,161 @@ Household Datapackage
 make:json.py : create JSON meta data for the Data Package
 
 """
+import logging
+logger = logging.getLogger(__name__)
 
+import os
 import json
+import hashlib
 import yaml
 
-# General metadata
+from .tools import Loader
 
-metadata_head = '''
-title: Household Data
-
-name: opsd_household_data
-
-description: Detailed household load and solar generation in minutely to hourly resolution
-
-long_description: This data package contains measured time series data for several small businesses 
-    and residential households relevant for household- or low-voltage-level power system modeling. 
-    The data includes solar power generation as well as electricity consumption (load) in a resolution 
-    up to single device consumption. The starting point for the time series, as well as data quality, 
-    varies between households, with gaps spanning from a few minutes to entire days. 
-    All measurement devices provided cumulative energy consumption/generation over time. Hence overall energy 
-    consumption/generation is retained, in case of data gaps due to communication problems. Measurements were 
-    conducted 1-minute intervals, with all data made available in an interpolated, uniform and regular time 
-    interval. All data gaps are either interpolated linearly, or filled with data of prior days. Additionally, 
-    data in 15 and 60-minute resolution is provided for compatibility with other time series data.
-    Data processing is conducted in Jupyter Notebooks/Python/pandas.
-
-documentation:
-    https://github.com/isc-konstanz/household_data/blob/{version}/main.ipynb
-
-version: '{version}'
-
-last_changes: '{changes}'
-
-keywords:
-    - Open Power System Data
-    - CoSSMic
-    - household data
-    - time series
-    - power systems
-    - in-feed
-    - renewables
-    - solar
-    - power consumption
-
-contributors:
-    - web: http://isc-konstanz.de/
-      name: Adrian Minde
-      email: adrian.minde@isc-konstanz.de
-
-sources:
-    - web: http://cossmic.eu/
-      name: CoSSMic
-      source: Collaborating Smart Solar-powered Microgrids - European funded research consortium
-      
-licenses:
-    - id: CC-BY-4.0
-      version: '4.0'
-      name: Creative Commons Attribution-International
-      url: https://creativecommons.org/licenses/by/4.0/
-
-external: true
+# General metadata
 
-'''
+metadata_head = {
+    'title': 'Household Data',
+    'name': 'opsd_household_data',
+    'description': 'Detailed household load and solar generation in minutely to hourly resolution',
+    'long_description': 'This data package contains measured time series data for several small businesses '
+        'and residential households relevant for household- or low-voltage-level power system modeling. '
+        'The data includes solar power generation as well as electricity consumption (load) in a resolution '
+        'up to single device consumption. The starting point for the time series, as well as data quality, '
+        'varies between households, with gaps spanning from a few minutes to entire days. '
+        'All measurement devices provided cumulative energy consumption/generation over time. Hence overall energy '
+        'consumption/generation is retained, in case of data gaps due to communication problems. Measurements were '
+        'conducted 1-minute intervals, with all data made available in an interpolated, uniform and regular time '
+        'interval. All data gaps are either interpolated linearly, or filled with data of prior days. Additionally, '
+        'data in 15 and 60-minute resolution is provided for compatibility with other time series data. '
+        'Data processing is conducted in Jupyter Notebooks/Python/pandas.',
+    'documentation': 'https://github.com/isc-konstanz/household_data/blob/{version}/main.ipynb',
+    'version': '{version}',
+    'last_changes': '{changes}',
+    'keywords': [
+        'Open Power System Data',
+        'CoSSMic',
+        'household data',
+        'time series',
+        'power systems',
+        'in-feed',
+        'renewables',
+        'solar',
+        'power consumption'
+    ],
+    'contributors': [
+        {
+            'web': 'http://isc-konstanz.de/',
+            'name': 'Adrian Minde',
+            'email': 'adrian.minde@isc-konstanz.de'
+        }
+    ],
+    'sources': [
+        {
+            'web': 'http://cossmic.eu/',
+            'name': 'CoSSMic',
+            'source': 'Collaborating Smart Solar-powered Microgrids - European funded research consortium'
+        }
+    ],
+    'licenses': [
+        {
+            'id': 'CC-BY-4.0',
+            'version': '4.0',
+            'name': 'Creative Commons Attribution-International',
+            'url': 'https://creativecommons.org/licenses/by/4.0/'
+        }
+    ],
+    'external': True
+}
 
 scope_template = '{number} households in southern Germany'
 
-resource_template = '''
-- path: household_data_{res_key}_singleindex.csv
-  format: csv
-  mediatype: text/csv
-  encoding: UTF8
-  schema: {res_key}
-  dialect: 
-      csvddfVersion: 1.0
-      delimiter: ","
-      lineTerminator: "\\n" 
-      header: true
-  alternative_formats:
-      - path: household_data_{res_key}_singleindex.csv
-        stacking: Singleindex
-        format: csv
-      - path: household_data.xlsx
-        stacking: Multiindex
-        format: xlsx
-      - path: household_data_{res_key}_multiindex.csv
-        stacking: Multiindex
-        format: csv
-      - path: household_data_{res_key}_stacked.csv
-        stacking: Stacked
-        format: csv
-'''
+xlsx_resource = {
+    'mediatype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'format': 'xlsx',
+    'path': 'household_data.xlsx'
+}
+
+
+def resource_template(res_key):
+    return {
+        'path': 'household_data_{}_singleindex.csv'.format(res_key),
+        'format': 'csv',
+        'mediatype': 'text/csv',
+        'encoding': 'UTF8',
+        'schema': res_key,
+        'dialect': {
+            'csvddfVersion': 1.0,
+            'delimiter': ',',
+            'lineTerminator': '\n',
+            'header': True
+        },
+        'alternative_formats': [
+            {
+                'path': 'household_data_{}_singleindex.csv'.format(res_key),
+                'stacking': 'Singleindex',
+                'format': 'csv'
+            },
+            {
+                'path': 'household_data.xlsx',
+                'stacking': 'Multiindex',
+                'format': 'xlsx'
+            },
+            {
+                'path': 'household_data_{}_multiindex.csv'.format(res_key),
+                'stacking': 'Multiindex',
+                'format': 'csv'
+            },
+            {
+                'path': 'household_data_{}_stacked.csv'.format(res_key),
+                'stacking': 'Stacked',
+                'format': 'csv'
+            }
+        ]
+    }
+
+
+def schemas_template(utc, cet, marker):
+    return {
+        'primaryKey': utc,
+        'missingValue': '',
+        'fields': [
+            {
+                'name': utc,
+                'description': 'Start of timeperiod in Coordinated Universal Time',
+                'type': 'datetime',
+                'format': 'fmt:%Y-%m-%dT%H%M%SZ',
+                'opsd-contentfilter': True
+            },
+            {
+                'name': cet,
+                'description': 'Start of timeperiod in Central European (Summer-) Time',
+                'type': 'datetime',
+                'format': 'fmt:%Y-%m-%dT%H%M%S%z'
+            },
+            {
+                'name': marker,
+                'description': 'marker to indicate which columns are missing data in source data '
+                    'and has been interpolated (e.g. DE_KN_Residential1_grid_import;)',
+                'type': 'string'
+            }
+        ]
+    }
+
+
+def field_template(h):
+    return {
+        'name': '_'.join((h['region'], h['household'], h['feed'])),
+        'description': h['description'],
+        'type': 'number (float)',
+        'unit': h['unit'],
+        'opsd-properties': {
+            'Region': h['region'],
+            'Type': h['type'],
+            'Household': h['household'],
+            'Feed': h['feed']
+        }
+    }
 
-schemas_template = '''
-{res_key}:
-    primaryKey: {utc}
-    missingValue: ""
-    fields:
-      - name: {utc}
-        description: Start of timeperiod in Coordinated Universal Time
-        type: datetime
-        format: fmt:%Y-%m-%dT%H%M%SZ
-        opsd-contentfilter: true
-      - name: {cet}
-        description: Start of timeperiod in Central European (Summer-) Time
-        type: datetime
-        format: fmt:%Y-%m-%dT%H%M%S%z
-      - name: {marker}
-        description: marker to indicate which columns are missing data in source data
-            and has been interpolated (e.g. DE_KN_Residential1_grid_import;)
-        type: string
-'''
-
-field_template = '''
-      - name: {region}_{household}_{feed}
-        description: {description}
-        type: number (float)
-        unit: {unit}
-        opsd-properties: 
-            Region: {region}
-            Type: {type}
-            Household: {household}
-            Feed: {feed}
-'''
 
 region_template = '''
 DE_KN: Germany, Konstanz
@@ -168,6 +201,10 @@ area: Energy consumption of an area, consisting of several smaller loads, in a {
 default: Energy in {unit}
 '''
 
+# The lookup tables above are constant, parse them only once on import
+_TYPES = yaml.load(type_template, Loader=Loader)
+_DESCRIPTIONS = yaml.load(descriptions_template, Loader=Loader)
+
 # Dataset-specific metadata
 
 # For each dataset/outputfile, the metadata has an entry in the
@@ -177,8 +214,82 @@ default: Energy in {unit}
 # For the other fields, we iterate over the columns
 # of the MultiIndex index of the datasets to contruct the corresponding
 # metadata.
-# The file is constructed from different buildings blocks made up of YAML-strings
-# as this makes for  more readable code.
+# The file is constructed from different building blocks made up of Python
+# dicts, which are serialized to JSON directly.
+
+
+def describe(feed, building_type, unit):
+    '''
+    Look up the description of a feed, falling back to the description of
+    its prefix or the default description.
+
+    Parameters
+    ----------
+    feed : str
+        Name of the feed, e.g. grid_import
+    building_type : str
+        Type of the household, as listed in the type template
+    unit : str
+        Unit of the feed
+
+    Returns
+    ----------
+    description : str
+        Description of the feed
+
+    '''
+    description = _DESCRIPTIONS.get(feed)
+    if description is None:
+        prefix = feed.split(sep="_")[0]
+        description = _DESCRIPTIONS.get(prefix, _DESCRIPTIONS['default'])
+
+    return description.format(type=_TYPES[building_type], unit=unit)
+
+
+# Sentinel written next to datapackage.json, see make_json()
+cache_prefix = '.datapackage.cache.'
+
+
+def cache_key(data_columns, info_cols, version, changes, headers):
+    '''
+    Hash all inputs the datapackage.json is derived from, including the
+    source of this module with its metadata and templates.
+
+    Parameters
+    ----------
+    data_columns: list of tuples
+        The series resolution and the tuple of column tuples of each
+        DataFrame, in the order of the data sets
+    info_cols : dict of strings
+        Names for non-data columns such as for the index, for additional 
+        timestamps or the marker column
+    version: str
+        Version tag of the Data Package
+    changes : str
+        Desription of the changes from the last version to this one.
+    headers : list
+        List of strings indicating the level names of the pandas.MultiIndex
+        for the columns of the dataframe.
+
+    Returns
+    ----------
+    key : str
+        Hex digest identifying the metadata of the passed data sets
+
+    '''
+    hasher = hashlib.sha256()
+
+    # The static metadata and templates of this module go into the output too
+    with open(__file__, 'rb') as f:
+        hasher.update(f.read())
+
+    for item in (version, changes, sorted(info_cols.items()), list(headers)):
+        hasher.update(repr(item).encode('utf-8'))
+    # Resources and schemas are written in the order of the data sets
+    for res_key, columns in data_columns:
+        hasher.update(repr((res_key, columns)).encode('utf-8'))
+
+    return hasher.hexdigest()
 
 
 def make_json(data_sets, info_cols, version, changes, headers):
@@ -186,6 +297,12 @@ def make_json(data_sets, info_cols, version, changes, headers):
     Create a datapackage.json file that complies with the Frictionless
     data JSON Table Schema from the information in the column-MultiIndex.
 
+    The file is written to the current working directory, together with an
+    empty .datapackage.cache.<sha256> sentinel. It records the inputs of the
+    last build, and the build is skipped while both files exist and the
+    inputs are unchanged. It is not part of the published data package and
+    may be deleted to force a rebuild.
+
     Parameters
     ----------
     data_sets: dict of pandas.DataFrames
@@ -208,67 +325,81 @@ def make_json(data_sets, info_cols, version, changes, headers):
 
     '''
 
-    # list of files included in the datapackage in YAML-format
-    resource_list = '''
-- mediatype: application/vnd.openxmlformats-officedocument.spreadsheetml.sheet
-  format: xlsx
-  path: household_data.xlsx
-'''
-    regions_list = [] # list of geographical scopes and households
-    schemas_dict = ''  # dictionary of schemas in YAML-format
-
+    # Build the column tuples of every dataset once from the level arrays
+    data_columns = []
     for res_key, df in data_sets.items():
-        field_list = ''  # list of columns in a file in YAML-format
+        level_arrays = [df.columns.get_level_values(i).values
+                        for i in range(df.columns.nlevels)]
+        data_columns.append((res_key, tuple(zip(*level_arrays))))
+
+    # Skip the build if the metadata was already written for the same inputs
+    cache_file = cache_prefix + cache_key(
+        data_columns, info_cols, version, changes, headers)
+    if os.path.exists('datapackage.json') and os.path.exists(cache_file):
+        logger.warning('datapackage.json is up to date and was not written. '
+                       'Delete %s to create it again', cache_file)
+        return
+
+    # list of files included in the datapackage
+    resource_list = [xlsx_resource]
+    regions_set = set() # set of geographical scopes and households
+    schemas_dict = {}  # dictionary of schemas
+    info_col_set = frozenset(info_cols.values())
+    descriptions_dict = {}  # descriptions by feed, type and unit
+
+    fields_cache = {}  # data fields by column index, shared between datasets
+
+    for res_key, columns in data_columns:
+        schema = schemas_template(**info_cols)
 
         # Both datasets (15min and 60min) get an antry in the resource list
-        resource_list = resource_list + resource_template.format(
-            res_key=res_key)
-
-        # Create the list of of columns in a file, starting with the index
-        # field
-        for col in df.columns:
-            if col[0] in info_cols.values():
-                continue
-            h = {k: v for k, v in zip(headers, col)}
-            
-            region = h['region'] + '_' + h['household']
-            if region not in regions_list:
-                regions_list.append(region)
-            
-#             regions = yaml.load(region_template)
-#             h['region_desc'] = regions[h['region']
-            
-            types = yaml.load(type_template)
-            
-            descriptions = yaml.load(
-                descriptions_template.format(
-                    type=types[h['type']], unit=h['unit']))
-            try:
-                feed = h['feed']
-                prefix = feed.split(sep="_")[0]
-                if feed in descriptions:
-                    h['description'] = descriptions[feed]
-                else:
-                    h['description'] = descriptions[prefix]
-            except KeyError:
-                h['description'] = descriptions['default']
-            
-            field_list = field_list + field_template.format(**h)
+        resource_list.append(resource_template(res_key))
+
+        # Datasets with identical columns share the same list of fields
+        if columns not in fields_cache:
+            fields_cache[columns] = field_list = []  # list of columns in a file
+
+            # Create the list of of columns in a file, following the index
+            # fields
+            for col in columns:
+                if col[0] in info_col_set:
+                    continue
+                h = dict(zip(headers, col))
+                
+                regions_set.add((h['region'], h['household']))
+                
+#                 regions = yaml.load(region_template)
+#                 h['region_desc'] = regions[h['region']
+                
+                key = (h['feed'], h['type'], h['unit'])
+                if key not in descriptions_dict:
+                    descriptions_dict[key] = describe(*key)
+                h['description'] = descriptions_dict[key]
+                
+                field_list.append(field_template(h))
         
-        schemas_dict = schemas_dict + schemas_template.format(
-            res_key=res_key, **info_cols) + field_list
+        schema['fields'].extend(fields_cache[columns])
+        schemas_dict[res_key] = schema
 
-    # Parse the YAML-Strings and stitch the building blocks together
-    metadata = yaml.load(metadata_head.format(
-        version=version, changes=changes))
+    # Stitch the building blocks together
+    metadata = dict(metadata_head)
+    for key in ('documentation', 'version', 'last_changes'):
+        metadata[key] = metadata[key].format(version=version, changes=changes)
     
-    metadata['geographical-scope'] = scope_template.format(number=len(regions_list));
-    metadata['resources'] = yaml.load(resource_list)
-    metadata['schemas'] = yaml.load(schemas_dict)
-
-    # write the metadata to disk
-    datapackage_json = json.dumps(metadata, indent=4, separators=(',', ': '))
-    with open('datapackage.json', 'w') as f:
-        f.write(datapackage_json)
+    metadata['geographical-scope'] = scope_template.format(number=len(regions_set));
+    metadata['resources'] = resource_list
+    metadata['schemas'] = schemas_dict
+
+    # Invalidate the previous build before touching datapackage.json
+    for file_name in os.listdir('.'):
+        if file_name.startswith(cache_prefix):
+            os.remove(file_name)
+
+    # write the metadata to disk, replacing the file only once it is complete
+    with open('datapackage.json.tmp', 'w', buffering=1 << 20) as f:
+        json.dump(metadata, f, indent=4, separators=(',', ': '))
+    os.replace('datapackage.json.tmp', 'datapackage.json')
+
+    open(cache_file, 'w').close()
 
     return
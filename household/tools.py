@@ -11,6 +11,12 @@ import sys
 import numpy as np
 import pandas as pd
 
+# YAML loader backed by libyaml, if PyYAML was built with it
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
 
 def update_sets(key, data, data_sets):
     '''
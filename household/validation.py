@@ -16,7 +16,7 @@ import numpy as np
 import pandas as pd
 
 from datetime import datetime, timedelta
-from .tools import update_progress, derive_power
+from .tools import update_progress, derive_power, Loader
 
 
 def validate(household, household_data, config_dir='conf', verbose=False):
@@ -150,7 +150,7 @@ def _read_adjustments(household_id, config_dir):
     adjustments_file = os.path.join(config_dir, household_id+'.d', 'series.yml')
     if os.path.isfile(adjustments_file):
         with open(adjustments_file, 'r') as f:
-            adjustments_yaml = yaml.load(f.read(), Loader=yaml.FullLoader)
+            adjustments_yaml = yaml.load(f.read(), Loader=Loader)
             adjustments = adjustments_yaml['Adjustments']
     
     return adjustments